@@ -85,6 +85,13 @@ const DEMO_RESULTS = {
   ]
 };
 
+// Backend returns chartData column-wise ({ pressure: [...], excessFit: [...], ... });
+// Recharts and the CSV export want one object per point.
+const columnsToRows = (columns) =>
+  columns.pressure.map((_, i) =>
+    Object.fromEntries(Object.keys(columns).map((key) => [key, columns[key][i]]))
+  );
+
 const AdsorptionDashboard = () => {
   // --- State Management (Initialized with Demo Data) ---
   const [inputData, setInputData] = useState(DEMO_INPUT_DATA); // <--- Demo Data
@@ -151,7 +158,7 @@ const AdsorptionDashboard = () => {
       if(warnings.length > 0) alert(warnings.join('\n'));
 
       setResults({
-        chartData: firstSet.chartData,
+        chartData: columnsToRows(firstSet.chartData),
         parameters: {
             ...globalParams,
             b: firstSet.b
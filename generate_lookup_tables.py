@@ -1,6 +1,8 @@
 import CoolProp.CoolProp as CP
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
 
 # ---------------------------------------------------------
 # CONFIGURATION: "Mini-REFPROP" Ranges
@@ -9,38 +11,66 @@ GASES = ['Hydrogen', 'Methane', 'CarbonDioxide']
 T_RANGE = np.arange(50, 400, 2)      # 50K to 400K (2K steps)
 P_RANGE = np.arange(0, 50, 0.1)      # 0 to 50 MPa (0.1 MPa steps)
 
-data = []
+# One fluid handle per gas and worker process, so the per-point fallback
+# does not re-resolve the fluid
+_states = {}
 
-print("Generating high-precision EOS tables...")
-
-for gas in GASES:
+def isotherm_rows(args):
+    """Density rows for one (gas, T) isotherm; failed state points are skipped."""
+    gas, T = args
     # Map to CoolProp names
     cp_name = "H2" if gas == "Hydrogen" else "CH4" if gas == "Methane" else "CO2"
-    
-    print(f"Processing {gas}...")
-    
-    for T in T_RANGE:
-        for P_MPa in P_RANGE:
+
+    # CoolProp inputs: P in Pa, T in K. Output: Density in kg/m3
+    # One vectorized call per isotherm instead of one call per point.
+    P_Pa = P_RANGE * 1e6
+    try:
+        rho_kg_m3 = CP.PropsSI('D', 'T', np.full_like(P_Pa, T), 'P', P_Pa, cp_name)
+    except Exception:
+        if cp_name not in _states:
+            _states[cp_name] = CP.AbstractState("HEOS", cp_name)
+        state = _states[cp_name]
+        rho_kg_m3 = np.full_like(P_Pa, np.inf)
+        for i, p in enumerate(P_Pa):
             try:
-                # CoolProp inputs: P in Pa, T in K. Output: Density in kg/m3
-                P_Pa = P_MPa * 1e6
-                rho_kg_m3 = CP.PropsSI('D', 'T', T, 'P', P_Pa, cp_name)
-                
-                # Convert to g/cm3
-                rho_g_cm3 = rho_kg_m3 / 1000.0
-                
-                data.append({
-                    "Gas": gas,
-                    "T_K": round(T, 1),
-                    "P_MPa": round(P_MPa, 2),
-                    "Density_g_cm3": round(rho_g_cm3, 6)
-                })
+                state.update(CP.PT_INPUTS, p, T)
+                rho_kg_m3[i] = state.rhomass()
             except:
                 continue
 
-# Save to CSV in the backend folder
-# NOTE: Ensure the 'backend' folder exists relative to where you run this script
-df = pd.DataFrame(data)
-output_path = 'backend/gas_lookup.csv' 
-df.to_csv(output_path, index=False)
-print(f"✅ Done! Saved '{output_path}'. Now push this CSV to GitHub.")
\ No newline at end of file
+    # Convert to g/cm3 (failed state points come back as inf and are skipped)
+    rho_g_cm3 = np.asarray(rho_kg_m3) / 1000.0
+    ok = np.isfinite(rho_g_cm3)
+    return pd.DataFrame({
+        "Gas": gas,
+        "T_K": np.round(T, 1),
+        "P_MPa": np.round(P_RANGE[ok], 2),
+        "Density_g_cm3": np.round(rho_g_cm3[ok], 6)
+    })
+
+if __name__ == "__main__":
+    print("Generating high-precision EOS tables...")
+
+    # Isotherms are independent: spread them over all cores. map() keeps the
+    # gas -> T order, so the CSV comes out the same as a serial run.
+    with ProcessPoolExecutor() as executor:
+        df = pd.concat(
+            executor.map(isotherm_rows, product(GASES, T_RANGE), chunksize=8),
+            ignore_index=True
+        )
+
+    # Save to CSV in the backend folder
+    # NOTE: Ensure the 'backend' folder exists relative to where you run this script
+    output_path = 'backend/gas_lookup.csv'
+    df.to_csv(output_path, index=False)
+
+    # Same tables pre-gridded as float32 (T x P, missing points NaN) for fast loading
+    grids = {"gases": np.array(sorted(df["Gas"].unique()))}
+    for gas, sub in df.groupby("Gas"):
+        grid = sub.pivot(index="T_K", columns="P_MPa", values="Density_g_cm3")
+        grids[f"{gas}_T"] = grid.index.to_numpy(dtype=float)
+        grids[f"{gas}_P"] = grid.columns.to_numpy(dtype=float)
+        grids[f"{gas}_rho"] = grid.to_numpy(dtype=np.float32)
+    npz_path = 'backend/gas_lookup.npz'
+    np.savez_compressed(npz_path, **grids)
+    print(f"✅ Done! Saved '{output_path}' and '{npz_path}'. Now push them to GitHub.")